@@ -1,14 +1,149 @@
 from mcp.server.fastmcp import FastMCP, Context
-import json
-from datetime import datetime
-from typing import Dict, Optional
-from serpapi import GoogleSearch
-import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+import httpx
+import secrets
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from itertools import chain
+from operator import itemgetter
+import heapq
+import mmap
 import os
+import re
+import time
+
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        """Serialize obj to JSON bytes."""
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+    # orjson parses straight from a buffer, which makes memory-mapping worthwhile
+    _LOADS_FROM_BUFFER = True
+except ImportError:
+    # orjson is a declared dependency; fall back to ujson, then to the stdlib encoder
+    # so the server still runs where it cannot be installed
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+    def _dumps(obj) -> bytes:
+        """Serialize obj to JSON bytes."""
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+    _LOADS_FROM_BUFFER = False
+
+# Files smaller than this are read directly; mapping them costs more than it saves
+_MMAP_MIN_SIZE = 16 * 1024
+
+_SERPAPI_URL = "https://serpapi.com/search"
+
+# Parameters shared by every SerpAPI request; prices are always fetched in INR
+_SERPAPI_BASE = {
+    "engine": "google_flights",
+    "hl": "en",
+    "gl": "in",
+    "currency": "INR",
+}
+
+# Read once at import; search_flights reports an error if it is missing
+_API_KEY = os.getenv("SERPAPI_KEY")
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[dict]:
+    """
+    Provide an HTTP client for SerpAPI requests for the lifetime of a server run.
+    
+    FastMCP enters the lifespan once per run (once per connection under SSE), so
+    each run gets its own client and closing it never affects another session.
+    
+    Yields:
+        dict: Lifespan context holding the client under "http"
+    """
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        yield {"http": client}
 
 # Create an MCP server
-mcp = FastMCP("flight-booking-assistant", dependencies=["google-search-results"] ,env=["SERPAPI_KEY","TEMP_FLIGHT_SEARCH_DIR"])
+mcp = FastMCP("flight-booking-assistant", dependencies=["httpx", "orjson"] ,env=["SERPAPI_KEY","TEMP_FLIGHT_SEARCH_DIR"], lifespan=_lifespan)
+
+# Search IDs are secrets.token_hex(16) strings
+_SEARCH_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+def _parse_search_filename(name: str) -> Optional[Tuple[Optional[int], str]]:
+    """
+    Split a stored search filename into its save time and search ID.
+
+    Files are named ``search_<epoch_seconds>_<search_id>.json``. Files written
+    before the timestamp was embedded (``search_<search_id>.json``) yield a
+    save time of None.
+
+    Args:
+        name (str): Filename to parse
+
+    Returns:
+        Optional[Tuple[Optional[int], str]]: (save time, search ID), or None if not a search file
+    """
+    if not (name.startswith("search_") and name.endswith(".json")):
+        return None
+    stem = name[len("search_"):-len(".json")]
+    saved_at, sep, search_id = stem.partition("_")
+    if sep and saved_at.isdigit():
+        return int(saved_at), search_id
+    return None, stem
+
+def _write_atomic(file_path: Path, chunks: List[bytes]) -> None:
+    """
+    Write the concatenation of chunks to file_path so readers never observe a partial file.
+
+    The data goes to a hidden temporary file next to the target, which is then
+    renamed over it. The chunks are written with a single gathered write where
+    the platform supports it, so they never have to be joined in memory.
+
+    Args:
+        file_path (Path): Destination file
+        chunks (List[bytes]): File contents, in order
+    """
+    tmp_path = file_path.with_name(f".tmp_{file_path.name}")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        try:
+            written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+            if written < sum(map(len, chunks)):
+                # Short write (or no writev); finish from where it stopped
+                remaining = memoryview(b"".join(chunks))[written:]
+                while remaining:
+                    remaining = remaining[os.write(fd, remaining):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def _unlink_if_present(path: str) -> bool:
+    """
+    Delete a file, treating one that is already gone as deleted.
+
+    Args:
+        path (str): File to delete
+
+    Returns:
+        bool: True if the file no longer exists
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    return True
 
 class FlightSearchStorage:
     """
@@ -17,14 +152,49 @@ class FlightSearchStorage:
     This class manages the storage and retrieval of flight search results in temporary files.
     It provides methods to save, retrieve, and clean up old search results.
     
+    Recently used results are also kept in memory so a search followed by
+    filtering doesn't have to re-read and re-parse the file.
+    
     Attributes:
         temp_dir (Path): Directory path for storing temporary search results
     """
+    # Maximum number of searches kept in memory
+    MEMORY_CACHE_SIZE = 64
+    # Threads used to delete expired files
+    CLEANUP_WORKERS = 8
+
     def __init__(self):
         """Initialize the storage with a temporary directory for search results."""
-        self.temp_dir = Path(os.getenv("TEMP_FLIGHT_SEARCH_DIR")) 
+        temp_dir = os.getenv("TEMP_FLIGHT_SEARCH_DIR")
+        if not temp_dir:
+            raise RuntimeError("TEMP_FLIGHT_SEARCH_DIR environment variable is not set")
+        self.temp_dir = Path(temp_dir).resolve()
         # Create the temporary directory if it doesn't exist
         self.temp_dir.mkdir(exist_ok=True)
+        # Map search IDs to their files so lookups don't need to scan the directory.
+        # Files without a timestamp in their name hold the old result format and
+        # are left for cleanup only.
+        self._paths: Dict[str, Path] = {}
+        with os.scandir(self.temp_dir) as entries:
+            for entry in entries:
+                parsed = _parse_search_filename(entry.name)
+                if parsed is not None and parsed[0] is not None:
+                    self._paths[parsed[1]] = Path(entry.path)
+        # Least recently used searches first
+        self._mem: OrderedDict[str, dict] = OrderedDict()
+    
+    def _remember(self, search_id: str, data: dict) -> None:
+        """
+        Add stored search data to the in-memory cache, evicting the least recently used entry.
+        
+        Args:
+            search_id (str): Unique identifier for the search
+            data (dict): Stored data, as returned by get_search_results
+        """
+        self._mem[search_id] = data
+        self._mem.move_to_end(search_id)
+        if len(self._mem) > self.MEMORY_CACHE_SIZE:
+            self._mem.popitem(last=False)
     
     def save_search_results(self, search_id: str, results: dict) -> None:
         """
@@ -34,12 +204,34 @@ class FlightSearchStorage:
             search_id (str): Unique identifier for the search
             results (dict): Flight search results to store
         """
-        file_path = self.temp_dir / f"search_{search_id}.json"
-        with open(file_path, 'w') as f:
-            json.dump({
-                'timestamp': datetime.now().isoformat(),
-                'results': results
-            }, f)
+        saved_at = time.time()
+        file_path = self.temp_dir / f"search_{int(saved_at)}_{search_id}.json"
+        data = {
+            'ts': saved_at,
+            'results': results
+        }
+        # Frame the encoded results with the envelope instead of encoding a wrapper dict
+        _write_atomic(file_path, [b'{"ts":%b,"results":' % _dumps(saved_at), _dumps(results), b'}'])
+        self._paths[search_id] = file_path
+        self._remember(search_id, data)
+    
+    def _find_search_file(self, search_id: str) -> Optional[Path]:
+        """
+        Look up a search file on disk, for searches saved by another process sharing the directory.
+        
+        Args:
+            search_id (str): Unique identifier for the search
+            
+        Returns:
+            Optional[Path]: Path of the stored results if found, None otherwise
+        """
+        # Only well-formed IDs are globbed, so the pattern can't reach outside temp_dir
+        if not isinstance(search_id, str) or not _SEARCH_ID_RE.fullmatch(search_id):
+            return None
+        file_path = next(self.temp_dir.glob(f"search_*_{search_id}.json"), None)
+        if file_path is not None:
+            self._paths[search_id] = file_path
+        return file_path
     
     def get_search_results(self, search_id: str) -> Optional[dict]:
         """
@@ -51,32 +243,133 @@ class FlightSearchStorage:
         Returns:
             Optional[dict]: Stored search results if found, None otherwise
         """
-        file_path = self.temp_dir / f"search_{search_id}.json"
-        if file_path.exists():
-            with open(file_path, 'r') as f:
-                # print(f"Loading search results from {file_path}")
-                data = json.load(f)
-                # print(f"Loaded data: {data}")
-                return data
-        return None
+        data = self._mem.get(search_id)
+        if data is not None:
+            self._mem.move_to_end(search_id)
+            return data
+        
+        file_path = self._paths.get(search_id) or self._find_search_file(search_id)
+        if file_path is None:
+            return None
+        try:
+            with open(file_path, 'rb') as f:
+                if not _LOADS_FROM_BUFFER or os.fstat(f.fileno()).st_size < _MMAP_MIN_SIZE:
+                    data = _loads(f.read())
+                else:
+                    # Parse straight from the page cache instead of copying the file into memory first
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        data = _loads(view)
+        except FileNotFoundError:
+            self._paths.pop(search_id, None)
+            return None
+        self._remember(search_id, data)
+        return data
     
     def cleanup_old_searches(self, max_age_hours: int = 24) -> None:
         """
         Remove search results older than the specified age.
         
+        The save time is read from the filename, so files are never opened and
+        only files in the old naming scheme need a stat. Expired files are
+        collected first and then deleted on a small thread pool to overlap the
+        unlink calls.
+        
         Args:
             max_age_hours (int): Maximum age in hours for search results to keep
         """
-        current_time = datetime.now()
-        for file in self.temp_dir.glob("search_*.json"):
-            try:
-                with open(file, 'r') as f:
-                    data = json.load(f)
-                    file_time = datetime.fromisoformat(data['timestamp'])
-                    if (current_time - file_time).total_seconds() > max_age_hours * 3600:
-                        file.unlink()
-            except Exception:
-                continue
+        cutoff = time.time() - max_age_hours * 3600
+        expired = []
+        with os.scandir(self.temp_dir) as entries:
+            for entry in entries:
+                parsed = _parse_search_filename(entry.name)
+                if parsed is None:
+                    continue
+                saved_at, search_id = parsed
+                if saved_at is None:
+                    try:
+                        saved_at = entry.stat(follow_symlinks=False).st_mtime
+                    except OSError:
+                        continue
+                if saved_at < cutoff:
+                    expired.append((entry.path, search_id))
+        if not expired:
+            return
+        
+        with ThreadPoolExecutor(max_workers=self.CLEANUP_WORKERS) as executor:
+            removed = executor.map(_unlink_if_present, [path for path, _ in expired])
+            for (_, search_id), was_removed in zip(expired, removed):
+                if was_removed:
+                    self._paths.pop(search_id, None)
+                    self._mem.pop(search_id, None)
+
+# Optional segment fields and the defaults used when SerpAPI omits them
+_SEGMENT_DEFAULTS = {
+    "airline": "",
+    "flight_number": "",
+    "airplane": "",
+    "travel_class": "",
+    "duration": 0,  # Duration of this segment
+    "airline_logo": "",
+    "legroom": "",
+    "overnight": False,
+    "plane_and_crew_by": "",
+    "often_delayed_by_over_30_min": False,
+}
+
+def _transform_segment(segment: dict) -> dict:
+    """
+    Transform a single SerpAPI flight segment into the standardized format.
+
+    Args:
+        segment (dict): Raw flight segment from SerpAPI
+
+    Returns:
+        dict: Transformed flight segment
+    """
+    transformed = _SEGMENT_DEFAULTS.copy()
+    transformed.update((key, segment[key]) for key in segment.keys() & _SEGMENT_DEFAULTS.keys())
+    transformed["departure_airport"] = segment["departure_airport"]
+    transformed["arrival_airport"] = segment["arrival_airport"]
+    return transformed
+
+def _is_usable_itinerary(flight_itinerary: dict) -> bool:
+    """
+    Check that an itinerary has segments with the airport data the transform needs.
+
+    Args:
+        flight_itinerary (dict): Raw itinerary from SerpAPI
+
+    Returns:
+        bool: True if the itinerary can be transformed
+    """
+    segments = flight_itinerary.get("flights")
+    return bool(segments) and all(
+        "departure_airport" in segment and "arrival_airport" in segment for segment in segments
+    )
+
+def _transform_itinerary(flight_itinerary: dict, currency: str) -> dict:
+    """
+    Transform a SerpAPI itinerary into the standardized flight format.
+
+    Args:
+        flight_itinerary (dict): Raw itinerary from SerpAPI, with at least one segment
+        currency (str): Currency code the prices are in
+
+    Returns:
+        dict: Transformed flight
+    """
+    segments = flight_itinerary["flights"]
+    flight_segments = [_transform_segment(segment) for segment in segments]
+    return {
+        "price": float(flight_itinerary.get("price", 0)),
+        "currency": currency,
+        "total_duration": int(flight_itinerary.get("total_duration", 0)),  # Total journey duration
+        "stops": len(segments) - 1,  # Number of stops (segments - 1)
+        "type": flight_itinerary.get("type", ""),  # Round trip/One way
+        "airline_logo": flight_itinerary.get("airline_logo", ""),
+        "segments": flight_segments,  # All flight segments including layovers
+        "carbon_emissions": flight_itinerary.get("carbon_emissions", {})
+    }
 
 class FlightBookingServer:
     """
@@ -85,83 +378,79 @@ class FlightBookingServer:
     This server provides tools and resources for flight search and booking.
     It handles airport code lookup, flight search, and result filtering.
     """
-    def __init__(self):
-        """Initialize the flight booking server with storage and airport data."""
-        self.storage = FlightSearchStorage()
+    def __init__(self, storage: Optional[FlightSearchStorage] = None):
+        """
+        Initialize the flight booking server with storage and airport data.
 
-    def _transform_flight_data(self, api_response: dict, search_params: dict) -> dict:
+        Args:
+            storage (Optional[FlightSearchStorage]): Storage to use, a new one is created if omitted
         """
-        Transform SerpAPI response into standardized flight data format.
+        self.storage = storage if storage is not None else FlightSearchStorage()
+
+    def _count_itineraries(self, api_response: dict) -> int:
+        """
+        Count the itineraries in a SerpAPI response that can be transformed into flights.
         
         Args:
             api_response (dict): Raw response from SerpAPI
-            search_params (dict): Search parameters used
             
         Returns:
-            dict: Transformed flight data
+            int: Number of flights _transform_flight_data would produce
         """
-        transformed_flights = []
-        
-        # Combine best_flights and other_flights
-        all_flights = api_response.get("best_flights", []) + api_response.get("other_flights", [])
+        all_flights = chain(api_response.get("best_flights", []), api_response.get("other_flights", []))
+        return sum(1 for flight_itinerary in all_flights if _is_usable_itinerary(flight_itinerary))
+
+    def _transform_flight_data(self, api_response: dict, search_params: dict) -> List[dict]:
+        """
+        Transform SerpAPI response into standardized flight data format.
         
-        for flight_itinerary in all_flights:
-            if not flight_itinerary.get("flights"):
-                continue
-                
-            flight_segments = []
-            for segment in flight_itinerary["flights"]:
-                flight_segments.append({
-                    "airline": segment.get("airline", ""),
-                    "flight_number": segment.get("flight_number", ""),
-                    "airplane": segment.get("airplane", ""),
-                    "travel_class": segment.get("travel_class", ""),
-                    "departure_airport": {
-                        "name": segment["departure_airport"]["name"],
-                        "id": segment["departure_airport"]["id"],
-                        "time": segment["departure_airport"]["time"]
-                    },
-                    "arrival_airport": {
-                        "name": segment["arrival_airport"]["name"],
-                        "id": segment["arrival_airport"]["id"],
-                        "time": segment["arrival_airport"]["time"]
-                    },
-                    "duration": segment.get("duration", 0),  # Duration of this segment
-                    "airline_logo": segment.get("airline_logo", ""),
-                    "legroom": segment.get("legroom", ""),
-                    "overnight": segment.get("overnight", False),
-                    "plane_and_crew_by": segment.get("plane_and_crew_by", ""),
-                    "often_delayed_by_over_30_min": segment.get("often_delayed_by_over_30_min", False)
-                })
+        Args:
+            api_response (dict): Raw response from SerpAPI
+            search_params (dict): Search parameters used
             
-            transformed_flights.append({
-                "price": float(flight_itinerary.get("price", 0)),
-                "currency": search_params.get("currency", "USD"),
-                "total_duration": int(flight_itinerary.get("total_duration", 0)),  # Total journey duration
-                "stops": len(flight_itinerary["flights"]) - 1,  # Number of stops (segments - 1)
-                "type": flight_itinerary.get("type", ""),  # Round trip/One way
-                "airline_logo": flight_itinerary.get("airline_logo", ""),
-                "segments": flight_segments,  # All flight segments including layovers
-                "carbon_emissions": flight_itinerary.get("carbon_emissions", {}),
-                # For convenience, also include direct references to first and last flight
-                "departure": {
-                    "airport": flight_segments[0]["departure_airport"],
-                    "time": flight_segments[0]["departure_airport"]["time"]
-                },
-                "arrival": {
-                    "airport": flight_segments[-1]["arrival_airport"],
-                    "time": flight_segments[-1]["arrival_airport"]["time"]
-                }
-            })
-        
-        return {
-            "search_id": str(uuid.uuid4()),
-            # "search_id": 1,
-            "timestamp": datetime.now().isoformat(),
-            "search_params": search_params,
-            "flights": transformed_flights,
-            "status": "success"
-        }
+        Returns:
+            List[dict]: Transformed flights
+        """
+        currency = search_params.get("currency", "USD")
+        # Combine best_flights and other_flights without building a temporary list
+        all_flights = chain(api_response.get("best_flights", []), api_response.get("other_flights", []))
+        return [
+            _transform_itinerary(flight_itinerary, currency)
+            for flight_itinerary in all_flights
+            if _is_usable_itinerary(flight_itinerary)
+        ]
+
+def _departure_time(flight: dict) -> str:
+    """
+    Return the departure time of a transformed flight's first segment.
+
+    Args:
+        flight (dict): Transformed flight
+
+    Returns:
+        str: Departure time as given by SerpAPI
+    """
+    return flight["segments"][0]["departure_airport"]["time"]
+
+# Sort keys accepted by filter_flights' sort_by
+_SORT_KEYS = {
+    "price": itemgetter("price"),
+    "duration": itemgetter("total_duration"),
+    "departure_time": _departure_time,
+}
+
+@cache
+def _get_server() -> FlightBookingServer:
+    """
+    Return the shared server, creating it on first use.
+    
+    Created lazily rather than at import so the module can be loaded (e.g. by
+    `mcp install`) before TEMP_FLIGHT_SEARCH_DIR is set.
+    
+    Returns:
+        FlightBookingServer: Server instance reused across tool calls
+    """
+    return FlightBookingServer(FlightSearchStorage())
 
 @mcp.prompt()
 def flight_booking_assistant() -> str:
@@ -237,11 +526,10 @@ async def search_flights(
     Returns:
         Dict: Search results with a unique search ID
     """
-    server = FlightBookingServer()
+    server = _get_server()
     
     # Validate API key
-    api_key = os.getenv("SERPAPI_KEY")
-    if not api_key:
+    if not _API_KEY:
         return {
             "status": "error",
             "error": "SERPAPI_KEY environment variable is not set"
@@ -253,26 +541,33 @@ async def search_flights(
         "arrival_id": arrival_id,
         "outbound_date": outbound_date,
         "return_date": return_date,
-        "currency": "INR",
+        "currency": _SERPAPI_BASE["currency"],
         "type": 1 if return_date else 2  # 1 for round trip, 2 for one way
     }
 
     # Prepare API parameters
-    params = {
-        "engine": "google_flights",
-        "hl": "en",
-        "gl": "in",
-        "api_key": api_key,
-        **search_params
-    }
+    params = _SERPAPI_BASE | search_params | {"api_key": _API_KEY}
 
     try:
         # Report progress to the user
         await ctx.info(f"Searching flights from {departure_id} to {arrival_id}...")
         
-        # Perform the search
-        search = GoogleSearch(params)
-        api_response = search.get_dict()
+        # Perform the search without blocking the event loop; unset parameters are left out
+        response = await ctx.request_context.lifespan_context["http"].get(
+            _SERPAPI_URL,
+            params={key: value for key, value in params.items() if value is not None}
+        )
+        # SerpAPI reports failures as {"error": ...}; other error pages (e.g. from a gateway) may not be JSON
+        if response.is_error:
+            try:
+                message = _loads(response.content)["error"]
+            except (ValueError, KeyError, TypeError):
+                message = f"HTTP {response.status_code}"
+            return {
+                "status": "error",
+                "error": f"API Error: {message}"
+            }
+        api_response = _loads(response.content)
 
         # Check if we got valid results
         if "error" in api_response:
@@ -281,17 +576,20 @@ async def search_flights(
                 "error": f"API Error: {api_response['error']}"
             }
 
-        # Transform the response
-        transformed_data = server._transform_flight_data(api_response, search_params)
-        
-        # Store the results
-        server.storage.save_search_results(transformed_data["search_id"], transformed_data)
+        # Store the raw itineraries; they are only transformed if the results get filtered
+        search_id = secrets.token_hex(16)
+        server.storage.save_search_results(search_id, {
+            "search_id": search_id,
+            "search_params": search_params,
+            "best_flights": api_response.get("best_flights", []),
+            "other_flights": api_response.get("other_flights", [])
+        })
         
         return {
             "status": "success",
-            "search_id": transformed_data["search_id"],
-            "flights_count": len(transformed_data["flights"]),
-            "currency": currency,
+            "search_id": search_id,
+            "flights_count": server._count_itineraries(api_response),
+            "currency": search_params["currency"],
             # "path": server.storage.temp_dir,
             # "transformed_data": transformed_data
         }
@@ -319,14 +617,27 @@ def filter_flights(
             - departure_time_range (Tuple[str, str]): Time range for departure
             - sort_by (str): Field to sort by (price, duration, departure_time)
             - sort_order (str): Sort order (asc, desc)
+            - offset (int): Number of matching flights to skip, for paging
+            - limit (int): Maximum number of flights to return
             
     Returns:
         Dict: Filtered and sorted flight results with counts
     """
+    # Validate paging before doing any work
+    offset = filters.get("offset")
+    limit = filters.get("limit")
+    for name, value in (("offset", offset), ("limit", limit)):
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            return {
+                "status": "error",
+                "error": f"{name} must be a non-negative integer"
+            }
+    offset = offset or 0
+    
     # Load the search results from the storage
     search_id = filters.get("search_id")
-    storage = FlightSearchStorage()
-    flights_data = storage.get_search_results(search_id)
+    server = _get_server()
+    flights_data = server.storage.get_search_results(search_id)
 
     if not flights_data:
         return {
@@ -334,58 +645,61 @@ def filter_flights(
             "error": "No search results found for the provided search ID"
         }
     
-    # Get the flights from the results
-    # Another correct way:
-    flights = flights_data["results"]["flights"] if flights_data and "results" in flights_data else []
-    filtered_flights = []
-    # Apply filters
+    # Transform the stored itineraries into flights
+    results = flights_data.get("results")
+    if not isinstance(results, dict) or "search_params" not in results:
+        return {
+            "status": "error",
+            "error": "Stored search results are in an unrecognised format"
+        }
+    try:
+        flights = server._transform_flight_data(results, results["search_params"])
+    except (KeyError, TypeError, ValueError) as e:
+        return {
+            "status": "error",
+            "error": f"Failed to read stored search results: {str(e)}"
+        }
     
+    # Resolve the filters once so the loop only does cheap comparisons
+    max_price = filters.get("max_price")
+    max_duration = filters.get("max_duration")
+    max_stops = filters.get("max_stops")
+    preferred = frozenset(filters["preferred_airlines"]) if "preferred_airlines" in filters else None
+    start_time, end_time = filters["departure_time_range"] if "departure_time_range" in filters else (None, None)
+    
+    filtered_flights = []
     for flight in flights:
-        # Apply price filter
-        if "max_price" in filters:
-            if float(flight.get("price", float("inf"))) > filters["max_price"]:
-                continue
-        
-        # Apply duration filter
-        if "max_duration" in filters:
-            if int(flight.get("total_duration", float("inf"))) > filters["max_duration"]:
-                continue
-        
-        # Apply stops filter
-        if "max_stops" in filters:
-            if flight.get("stops", 0) > filters["max_stops"]:
-                continue
-        
-        # Apply airline filter
-        if "preferred_airlines" in filters:
-            # Check if any segment matches preferred airlines
-            segment_airlines = {segment["airline"] for segment in flight["segments"]}
-            if not any(airline in filters["preferred_airlines"] for airline in segment_airlines):
-                continue
-        
-        # Apply departure time filter
-        if "departure_time_range" in filters:
-            start_time, end_time = filters["departure_time_range"]
-            departure_time = flight["departure"]["time"]
-            if not (start_time <= departure_time <= end_time):
-                continue
-        
+        if max_price is not None and flight["price"] > max_price:
+            continue
+        if max_duration is not None and flight["total_duration"] > max_duration:
+            continue
+        if max_stops is not None and flight["stops"] > max_stops:
+            continue
+        # Keep the flight if any segment is operated by a preferred airline
+        if preferred is not None and preferred.isdisjoint(segment["airline"] for segment in flight["segments"]):
+            continue
+        if start_time is not None and not (start_time <= _departure_time(flight) <= end_time):
+            continue
         filtered_flights.append(flight)
     
-    # Apply sorting
-    if "sort_by" in filters:
-        sort_key = filters["sort_by"]
+    filtered_count = len(filtered_flights)
+    end = offset + limit if limit is not None else None
+    
+    # Apply sorting; with a limit only the flights up to the end of the page are selected instead of sorting everything
+    sort_key = _SORT_KEYS.get(filters.get("sort_by"))
+    if sort_key is not None:
         reverse = filters.get("sort_order", "asc") == "desc"
-        
-        if sort_key == "price":
-            filtered_flights.sort(key=lambda x: float(x.get("price", float("inf"))), reverse=reverse)
-        elif sort_key == "duration":
-            filtered_flights.sort(key=lambda x: int(x.get("total_duration", 0)), reverse=reverse)
-        elif sort_key == "departure_time":
-            filtered_flights.sort(key=lambda x: x["departure"]["time"], reverse=reverse)
+        if end is not None:
+            select = heapq.nlargest if reverse else heapq.nsmallest
+            filtered_flights = select(end, filtered_flights, key=sort_key)[offset:]
+        else:
+            filtered_flights.sort(key=sort_key, reverse=reverse)
+            filtered_flights = filtered_flights[offset:] if offset else filtered_flights
+    elif offset or end is not None:
+        filtered_flights = filtered_flights[offset:end]
     
     return {
-        "filtered_count": len(filtered_flights),
+        "filtered_count": filtered_count,
         "total_count": len(flights),
         "flights": filtered_flights,
         # "storage":storage.temp_dir / f"search_{search_id}.json"